@@ -0,0 +1,61 @@
+import hashlib
+import inspect
+import os
+import tempfile
+from functools import wraps
+from pathlib import Path
+
+import pandas as pd
+
+# Pickled DataFrames live here, keyed on source path, loader and modification time
+CACHE_DIR = Path(".cache")
+
+
+def _sha1(text):
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def cache_df(path):
+    """Cache the DataFrame returned by the wrapped loader until `path` or the loader's code changes.
+
+    The loader must accept a `log` keyword (default print); messages from the
+    cache and the loader both go through it.
+    """
+    def decorator(load):
+        # Name the loader by its defining file rather than __module__, which is
+        # "__main__" when that file is run as a script, so both scripts share entries
+        loader_name = f"{Path(inspect.getfile(load)).stem}.{load.__qualname__}"
+        prefix = _sha1(f"{path}|{loader_name}")
+        loader_version = _sha1(inspect.getsource(load))[:12]
+
+        @wraps(load)
+        def wrapper(*args, log=print, **kwargs):
+            cache_file = CACHE_DIR / f"{prefix}_{loader_version}_{os.stat(path).st_mtime_ns}.pkl"
+            if cache_file.exists():
+                try:
+                    df = pd.read_pickle(cache_file)
+                    log(f"Loaded cached DataFrame for {path}")
+                    return df
+                except Exception as e:
+                    # A damaged pickle is discarded and rebuilt from the source file
+                    log(f"Discarding unreadable cache file {cache_file}: {e}")
+                    cache_file.unlink(missing_ok=True)
+
+            df = load(*args, log=log, **kwargs)
+            CACHE_DIR.mkdir(exist_ok=True)
+            # Write to a temp file and move it into place, so an interrupted or
+            # concurrent run never leaves a half-written pickle under the final name
+            fd, tmp_name = tempfile.mkstemp(dir=CACHE_DIR, prefix=f"{prefix}_", suffix=".tmp")
+            os.close(fd)
+            try:
+                df.to_pickle(tmp_name)
+                os.replace(tmp_name, cache_file)
+            finally:
+                Path(tmp_name).unlink(missing_ok=True)
+            # Drop pickles from older file versions or older loader code
+            for stale in CACHE_DIR.glob(f"{prefix}_*.pkl"):
+                if stale != cache_file:
+                    stale.unlink(missing_ok=True)
+            return df
+        return wrapper
+    return decorator
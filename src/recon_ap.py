@@ -1,9 +1,13 @@
+import io
+import re
+import numpy as np
 import pandas as pd
 from pathlib import Path
-import pdfplumber
+import pymupdf
 from openpyxl import Workbook
 from openpyxl.drawing.image import Image as XLImage
 from datetime import datetime
+from df_cache import cache_df
 
 # ----------------------------------------------------
 # CONFIG
@@ -17,6 +21,25 @@ EXPECTED_SUPPLIER_TOTAL = 125000.00  # fallback if OCR fails
 EXPECTED_INVOICE_TOTAL = 5000.00     # invoice value
 # ----------------------------------------------------
 
+NUM_RE = re.compile(r"\d[\d,]*(?:\.\d+)?")  # amounts like 133,918.88
+KEY_RE = re.compile(r"(?i)balance|total")
+# Word extraction without clipping to the mediabox, so columns that run off the page are kept
+PDF_WORD_FLAGS = pymupdf.TEXTFLAGS_WORDS & ~pymupdf.TEXT_MEDIABOX_CLIP
+LINE_Y_TOLERANCE = 3  # points; words whose baselines are this close share a line
+
+
+def page_lines(page):
+    """Rebuild a page's visual text lines (one per table row) from its words"""
+    words = page.get_text("words", flags=PDF_WORD_FLAGS, clip=pymupdf.INFINITE_RECT())
+    lines = []  # [baseline, [(x0, word), ...]]
+    # Sort by baseline then x, so words within LINE_Y_TOLERANCE of each other are adjacent
+    for x0, _, _, y1, word, *_ in sorted(words, key=lambda w: (w[3], w[0])):
+        if lines and abs(y1 - lines[-1][0]) <= LINE_Y_TOLERANCE:
+            lines[-1][1].append((x0, word))
+        else:
+            lines.append([y1, [(x0, word)]])
+    return [" ".join(word for _, word in sorted(line_words)) for _, line_words in lines]
+
 
 def find_statement_pdf():
     print(f"STATEMENT_FOLDER: {STATEMENT_FOLDER}")
@@ -30,75 +53,77 @@ def find_statement_pdf():
 
 def extract_total_from_statement(pdf_path: Path) -> float:
     print(f"Extracting total from: {pdf_path}")
+    # Try to detect a number - look for balance at end or specific total lines.
+    # Pages are read last-first, so the common case stops after one page.
+    print("Searching for total amount...")
+    fallback = None  # first $/balance line with an amount, from the earliest page read so far
     try:
-        with pdfplumber.open(pdf_path) as pdf:
-            text = "\n".join(page.extract_text() for page in pdf.pages if page.extract_text())
-        print(f"Extracted text preview: {text[:200]}...")  # log first 200 chars
+        with pymupdf.open(pdf_path) as doc:
+            for page_no in reversed(range(doc.page_count)):
+                lines = page_lines(doc[page_no])
+                preview = "\n".join(lines)[:200]
+                print(f"Page {page_no + 1} text preview: {preview}...")  # log first 200 chars
+                for line in reversed(lines):  # Start from the end, often totals are at the bottom
+                    if KEY_RE.search(line):
+                        # Take the last number-like string from the line
+                        nums = NUM_RE.findall(line)
+                        if nums:
+                            total = float(nums[-1].replace(",", ""))
+                            print(f"Found total from balance/total line: '{line}' -> {total}")
+                            return total
+
+                # Fallback candidate: any number with $ or in running balance context
+                for line in lines:
+                    if "$" in line or "balance" in line.lower():
+                        # Take the last number on the line (usually the balance)
+                        nums = NUM_RE.findall(line)
+                        if nums:
+                            fallback = (line, float(nums[-1].replace(",", "")))
+                            break
     except:
         print("⚠️ Could not extract text from PDF, using expected total.")
         return EXPECTED_SUPPLIER_TOTAL
 
-    # Try to detect a number - look for balance at end or specific total lines
-    print("Searching for total amount...")
-    lines = text.splitlines()
-    for line in reversed(lines):  # Start from the end, often totals are at the bottom
-        if "balance" in line.lower() or "total" in line.lower():
-            # Extract the last number-like string from the line
-            words = line.split()
-            for word in reversed(words):
-                word_clean = "".join(ch for ch in word if ch.isdigit() or ch == "." or ch == ",")
-                word_clean = word_clean.replace(",", "")  # Remove commas
-                if word_clean and word_clean.replace(".", "").isdigit():
-                    print(f"Found total from balance/total line: '{line}' -> {word_clean}")
-                    return float(word_clean)
-
-    # Fallback: try to find any number with $ or in running balance context
-    for line in lines:
-        if ("$" in line or "balance" in line.lower()) and any(d in line for d in "0123456789"):
-            # Extract all numbers from the line and take the last one (usually balance)
-            words = line.split()
-            numbers = []
-            for word in words:
-                clean = "".join(ch for ch in word if ch.isdigit() or ch == "." or ch == ",")
-                clean = clean.replace(",", "")
-                if clean and clean.replace(".", "").isdigit():
-                    numbers.append(float(clean))
-            if numbers:
-                total = numbers[-1]  # Take the last number (usually the balance)
-                print(f"Found total from line: '{line}' -> {total}")
-                return total
+    if fallback:
+        line, total = fallback
+        print(f"Found total from line: '{line}' -> {total}")
+        return total
 
     print("No total found, using fallback.")
     return EXPECTED_SUPPLIER_TOTAL  # fallback
 
 
-def load_gl():
-    print(f"Loading GL from: {GL_FILE}")
-    df = pd.read_excel(GL_FILE)
-    print(f"GL loaded with shape: {df.shape}")
-    print(f"GL columns: {list(df.columns)}")
+@cache_df(GL_FILE)
+def load_gl(log=print):
+    log(f"Loading GL from: {GL_FILE}")
+    # calamine parses xlsx natively; read account_code as string at read time
+    df = pd.read_excel(GL_FILE, engine="calamine", dtype={"account_code": "string"})
+    # GL dates are ISO strings (2025-09-13); an explicit format keeps pandas on its
+    # fast parser, and errors="coerce" guarantees a datetime64 column (bad values -> NaT)
+    df["date"] = pd.to_datetime(df["date"], format="ISO8601", errors="coerce")
+    log(f"GL loaded with shape: {df.shape}")
+    log(f"GL columns: {list(df.columns)}")
     return df
 
 
 def filter_ap_activity(df):
     print(f"Filtering AP activity for account code: {AP_ACCOUNT_CODE}")
-    df = df[df["account_code"].astype(str) == AP_ACCOUNT_CODE].copy()
-    print(f"Filtered to {len(df)} AP entries")
-
-    print(f"Raw date column type: {df['date'].dtype}")
-    print(f"Sample raw dates: {df['date'].head()}")
-    # Force conversion to datetime - the issue might be that pd.to_datetime isn't working as expected
-    df['date'] = pd.to_datetime(df['date'], errors='coerce')
-    print(f"After pd.to_datetime: {df['date'].dtype}")
-    # If it's still object, try a different approach
-    if df['date'].dtype == 'object':
-        print("Still object, trying manual conversion...")
-        df['date'] = df['date'].apply(lambda x: pd.Timestamp(x) if pd.notnull(x) else pd.NaT)
-        print(f"After manual conversion: {df['date'].dtype}")
-    df.loc[:, "month"] = df["date"].dt.month
-
-    aug = df[df["month"] == 8]["credit"].sum() - df[df["month"] == 8]["debit"].sum()
-    sep = df[df["month"] == 9]["credit"].sum() - df[df["month"] == 9]["debit"].sum()
+    mask = (df["account_code"] == AP_ACCOUNT_CODE).to_numpy(dtype=bool, na_value=False)
+    print(f"Filtered to {mask.sum()} AP entries")
+    print(f"Date column type: {df['date'].dtype}")
+
+    # Work on the column arrays directly rather than materializing a filtered frame;
+    # rows without a parseable date are dropped along with non-AP rows
+    dates = df["date"].to_numpy()
+    keep = mask & ~np.isnat(dates)
+    months = dates[keep].astype("datetime64[M]").astype(int) % 12 + 1
+
+    # One bincount pass per column gives credit/debit totals for every month (index 1-12)
+    credit = np.bincount(months, weights=df["credit"].to_numpy(na_value=0.0)[keep], minlength=13)
+    debit = np.bincount(months, weights=df["debit"].to_numpy(na_value=0.0)[keep], minlength=13)
+
+    aug = credit[8] - debit[8]
+    sep = credit[9] - debit[9]
     movement = sep - aug
 
     print(f"August balance: {aug}")
@@ -141,15 +166,10 @@ def build_excel(statement_total, aug, sep, movement, invoice_pdf):
     ws2 = wb.create_sheet("Reconciliation Detail")
     ws2.append(["Supporting Invoice Screenshot:"])
 
-    invoice_png = f"{invoice_pdf.stem}.png"
-
-    # Safe screenshot generation (placeholder box)
-    with pdfplumber.open(invoice_pdf) as pdf:
-        first_page = pdf.pages[0]
-        page_img = first_page.to_image(resolution=150)
-        page_img.save(invoice_png)
-
-    img = XLImage(invoice_png)
+    # Rasterize the first page straight to in-memory PNG bytes (no temp file)
+    with pymupdf.open(invoice_pdf) as doc:
+        pix = doc[0].get_pixmap(dpi=150)
+    img = XLImage(io.BytesIO(pix.tobytes("png")))
     img.width = 500
     img.height = 650
     ws2.add_image(img, "A3")
@@ -1,10 +1,16 @@
 import pandas as pd
 import openpyxl
 from openpyxl import load_workbook
+from openpyxl.utils import get_column_letter
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 import os
+import weakref
 import openai
 from dotenv import load_dotenv
+from df_cache import cache_df
+from recon_ap import GL_FILE, load_gl
 
 # Load environment variables
 load_dotenv()
@@ -15,43 +21,64 @@ EMAILS_FILE = "Data/emails/demo_inbox_emails.xlsx"
 THRESHOLD_PERCENT = 10.0
 AP_ACCOUNT_CODE = "2000"  # Accounts Payable account code
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+BLANK_ROW_LIMIT = 2  # Stop scanning a sheet after this many consecutive empty rows
+COLS = tuple(get_column_letter(i) for i in range(1, 11))  # Letters for the 10 scanned columns
+
+# (column A label -> first row, last non-empty column A row), built once per worksheet by
+# label_index(); column A must only be written through set_label() so this never goes stale
+_label_indexes = weakref.WeakKeyDictionary()
+
+def _load_ro():
+    """Open the reconciliation workbook read-only; callers must close it"""
+    return load_workbook(EXCEL_FILE, read_only=True, data_only=True)
+
+def iter_populated_rows(ws, max_row=50, max_col=len(COLS)):
+    """Yield (row_number, values) from the top of a sheet until BLANK_ROW_LIMIT empty rows in a row"""
+    blanks = 0
+    for row, values in enumerate(ws.iter_rows(min_row=1, max_row=max_row, max_col=max_col, values_only=True), 1):
+        if all(value is None for value in values):
+            blanks += 1
+            if blanks >= BLANK_ROW_LIMIT:
+                break
+            continue
+        blanks = 0
+        yield row, values
+
+def label_index(ws, max_row=50):
+    """Return ({label_lower: first_row}, last_row) for column A, cached per worksheet"""
+    cached = _label_indexes.get(ws)
+    if cached is None:
+        index = {}
+        last_row = 1
+        for row, (label,) in iter_populated_rows(ws, max_row=max_row, max_col=1):
+            if label:
+                index.setdefault(str(label).lower(), row)
+                last_row = row
+        cached = _label_indexes[ws] = (index, last_row)
+    return cached
+
+def set_label(ws, row, value):
+    """Write a column A label and drop the worksheet's cached label index"""
+    ws[f"A{row}"] = value
+    _label_indexes.pop(ws, None)
 
 def read_mom_percentage():
     """Read the MoM % Change from the Excel file"""
     try:
-        # First try to get calculated values
-        wb = load_workbook(EXCEL_FILE, data_only=True)
-        ws = wb["AP Reconciliation Summary"]
-
-        # Find the MoM % Change cell
-        for row in range(1, 20):
-            cell_a = ws[f"A{row}"]
-            if cell_a.value and "MoM % Change" in str(cell_a.value):
-                cell_b = ws[f"B{row}"]
-                mom_percent = cell_b.value
-                print(f"Found MoM % Change (calculated): {mom_percent}")
-
-                if mom_percent is not None:
-                    # Handle percentage formatting
-                    if isinstance(mom_percent, str):
-                        mom_percent = mom_percent.replace('%', '').strip()
-                    return float(mom_percent)
-
-        # If no calculated value, try to calculate manually
-        wb = load_workbook(EXCEL_FILE, data_only=False)
-        ws = wb["AP Reconciliation Summary"]
-
-        # Get GL Balance August (row 3, column B)
+        # openpyxl does not evaluate formulas and recon_ap writes the file without
+        # cached results, so compute the % change from the literal Aug/Sep balances
         aug_balance = None
         sep_balance = None
 
-        for row in range(1, 20):
-            cell_a = ws[f"A{row}"]
-            cell_b = ws[f"B{row}"]
-            if cell_a.value == "GL Balance August":
-                aug_balance = float(cell_b.value) if cell_b.value else 0.0
-            elif cell_a.value == "GL Balance September":
-                sep_balance = float(cell_b.value) if cell_b.value else 0.0
+        # Read-only workbooks hold the file open until closed, including on errors
+        # (a missing sheet as well as a bad value)
+        with closing(_load_ro()) as wb:
+            ws = wb["AP Reconciliation Summary"]
+            for _, (a, b) in iter_populated_rows(ws, max_row=20, max_col=2):
+                if a == "GL Balance August":
+                    aug_balance = float(b) if b else 0.0
+                elif a == "GL Balance September":
+                    sep_balance = float(b) if b else 0.0
 
         if aug_balance is not None and sep_balance is not None and aug_balance != 0:
             mom_percent = ((sep_balance - aug_balance) / aug_balance) * 100
@@ -65,20 +92,16 @@ def read_mom_percentage():
         print(f"Error reading MoM percentage: {e}")
         return 0.0
 
-def read_ap_summary():
+def read_ap_summary(wb):
     """Read all information from AP Reconciliation Summary tab"""
     try:
-        wb = load_workbook(EXCEL_FILE)
         ws = wb["AP Reconciliation Summary"]
 
-        # Extract all content from the summary sheet
+        # Extract all content from the summary sheet (first 50 rows, first 10 columns)
         summary_info = []
-        for row in range(1, 50):  # Check first 50 rows
-            row_data = []
-            for col in range(1, 10):  # Check first 10 columns
-                cell = ws.cell(row=row, column=col)
-                if cell.value:
-                    row_data.append(f"{chr(64+col)}{row}: {cell.value}")  # Add cell reference like A1: Value
+        for row, values in iter_populated_rows(ws):
+            # Add cell reference like A1: Value
+            row_data = [f"{col}{row}: {value}" for col, value in zip(COLS, values) if value]
             if row_data:
                 summary_info.append(" | ".join(row_data))
 
@@ -90,19 +113,17 @@ def read_ap_summary():
         print(f"Error reading AP summary: {e}")
         return ""
 
-def read_reconciliation_detail():
+def read_reconciliation_detail(wb):
     """Read information from Reconciliation Detail tab including images"""
     try:
-        wb = load_workbook(EXCEL_FILE)
         ws = wb["Reconciliation Detail"]
 
-        # Extract any text content from the detail sheet
+        # Extract any text content from the detail sheet (first 50 rows, first 10 columns)
         detail_info = []
-        for row in range(1, 50):  # Check first 50 rows
-            for col in range(1, 10):  # Check first 10 columns
-                cell = ws.cell(row=row, column=col)
-                if cell.value:
-                    detail_info.append(str(cell.value))
+        for _, values in iter_populated_rows(ws):
+            for value in values:
+                if value:
+                    detail_info.append(str(value))
 
         detail_text = " ".join(detail_info)
         print(f"Reconciliation Detail content: {detail_text[:500]}...")
@@ -122,79 +143,70 @@ def read_reconciliation_detail():
         print(f"Error reading reconciliation detail: {e}")
         return ""
 
-def read_emails_for_investigation():
+@cache_df(EMAILS_FILE)
+def load_emails(log=print):
+    """Load the demo inbox emails into a DataFrame"""
+    return pd.read_excel(EMAILS_FILE, engine="calamine")
+
+def read_emails_for_investigation(log=print):
     """Read emails from demo_inbox_emails.xlsx for investigation context"""
     try:
-        df = pd.read_excel(EMAILS_FILE)
-        print(f"Loaded {len(df)} emails from {EMAILS_FILE}")
-
-        # Get all email content as structured text
-        email_details = []
-        for _, row in df.iterrows():
-            email_info = []
-            for col in df.columns:
-                if pd.notnull(row[col]):
-                    email_info.append(f"{col}: {row[col]}")
-            email_details.append(" | ".join(email_info))
-
-        combined_emails = "\n".join(email_details)
-        print(f"Email content preview: {combined_emails[:500]}...")
+        df = load_emails(log=log)
+        log(f"Loaded {len(df)} emails from {EMAILS_FILE}")
+
+        # Get all email content as pipe-delimited text (header row + one line per email)
+        combined_emails = df.to_csv(sep="|", index=False)
+        log(f"Email content preview: {combined_emails[:500]}...")
         return combined_emails
 
     except Exception as e:
-        print(f"Error reading emails: {e}")
+        log(f"Error reading emails: {e}")
         return ""
 
-def read_september_gl_entries():
+def read_september_gl_entries(log=print):
     """Read GL entries for September month and AP account code 2000"""
     try:
-        gl_file = "Data/gl/sample_gl_aug_sep_cleaned.xlsx"
-        df = pd.read_excel(gl_file)
-        print(f"Loaded {len(df)} GL entries from {gl_file}")
+        # Shares recon_ap's cached GL read
+        df = load_gl(log=log)
+        log(f"Loaded {len(df)} GL entries from {GL_FILE}")
 
-        # Filter for September entries (month 9) and AP account code
-        df['date'] = pd.to_datetime(df['date'], errors='coerce')
-        sept_entries = df[df['date'].dt.month == 9]
-
-        # Further filter for AP account code 2000 (assuming 'account' column)
+        # Filter for September entries (month 9) and AP account code 2000
+        # (prefer an 'account' column, else the first column mentioning account)
         if 'account' in df.columns:
-            sept_ap_entries = sept_entries[sept_entries['account'].astype(str) == AP_ACCOUNT_CODE]
+            account_col = 'account'
+        else:
+            account_col = next((col for col in df.columns if 'account' in col.lower()), None)
+
+        mask = df['date'].dt.month == 9
+        if account_col:
+            mask &= df[account_col].astype(str) == AP_ACCOUNT_CODE
         else:
-            # Fallback: try 'account_code' or 'acct_code' or similar
-            account_col = None
-            for col in df.columns:
-                if 'account' in col.lower():
-                    account_col = col
-                    break
-            if account_col:
-                sept_ap_entries = sept_entries[sept_entries[account_col].astype(str) == AP_ACCOUNT_CODE]
-            else:
-                print("Warning: Could not find account column in GL file, using all September entries")
-                sept_ap_entries = sept_entries
-
-        print(f"Found {len(sept_ap_entries)} September AP GL entries for account {AP_ACCOUNT_CODE}")
-
-        # Format GL entries for AI analysis
-        gl_details = []
-        for _, row in sept_ap_entries.iterrows():
-            gl_info = []
-            for col in df.columns:
-                if pd.notnull(row[col]):
-                    gl_info.append(f"{col}: {row[col]}")
-            gl_details.append(" | ".join(gl_info))
-
-        combined_gl = "\n".join(gl_details)
-        print(f"September AP GL entries preview: {combined_gl[:500]}...")
+            log("Warning: Could not find account column in GL file, using all September entries")
+        sept_ap_entries = df[mask]
+
+        log(f"Found {len(sept_ap_entries)} September AP GL entries for account {AP_ACCOUNT_CODE}")
+
+        # Summarize GL entries for AI analysis: column statistics plus the largest movements
+        net_movement = (sept_ap_entries["credit"] - sept_ap_entries["debit"]).abs()
+        top_entries = sept_ap_entries.loc[net_movement.nlargest(5).index]
+        combined_gl = (
+            f"{len(sept_ap_entries)} entries. Summary statistics:\n"
+            f"{sept_ap_entries.describe().to_string()}\n"
+            f"Top {len(top_entries)} entries by abs(credit - debit):\n"
+            f"{top_entries.to_csv(sep='|', index=False)}"
+        )
+        log(f"September AP GL entries preview: {combined_gl[:500]}...")
         return combined_gl
 
     except Exception as e:
-        print(f"Error reading September GL entries: {e}")
+        log(f"Error reading September GL entries: {e}")
         return ""
 
 def generate_investigation_reason(mom_percent, summary_info, detail_info, sept_gl_info, email_content):
     """Use OpenAI API to generate a reason for the large movement"""
 
     if not OPENAI_API_KEY:
+        print("OpenAI API key not found in environment variables")
         return "Error: OpenAI API key not found in environment variables"
 
     # Prepare the context for OpenAI
@@ -238,17 +250,27 @@ def generate_investigation_reason(mom_percent, summary_info, detail_info, sept_g
     try:
         client = openai.OpenAI(api_key=OPENAI_API_KEY)
 
-        response = client.chat.completions.create(
-            model="gpt-4",
+        stream = client.chat.completions.create(
+            model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "You are a Senior Accounts Payable Accountant with extensive experience in financial reconciliation, variance analysis, and audit documentation. You write clear, professional explanations that are suitable for financial reporting and audit reviews. Your explanations are evidence-based and include appropriate recommendations for further investigation."},
                 {"role": "user", "content": prompt}
             ],
             max_tokens=400,
-            temperature=0.2  # Lower temperature for more professional, consistent responses
+            temperature=0.2,  # Lower temperature for more professional, consistent responses
+            stream=True
         )
 
-        content = response.choices[0].message.content
+        # Print tokens as they arrive so the analysis shows up while it is generated
+        parts = []
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                print(delta, end="", flush=True)
+                parts.append(delta)
+        print()
+
+        content = "".join(parts)
         if content:
             reason = content.strip()
         else:
@@ -259,90 +281,93 @@ def generate_investigation_reason(mom_percent, summary_info, detail_info, sept_g
         print(f"Error calling OpenAI API: {e}")
         return f"Unable to generate AI analysis due to API error: {str(e)}"
 
-def clear_previous_reason():
+def clear_previous_reason(wb):
     """Clear any existing 'Reason' from the Excel summary sheet"""
     try:
-        wb = load_workbook(EXCEL_FILE)
         ws = wb["AP Reconciliation Summary"]
 
         # Find and remove the Reason row
-        for row in range(1, 50):
-            if ws[f"A{row}"].value and str(ws[f"A{row}"].value).lower() == "reason":
-                # Clear the row
-                ws[f"A{row}"] = None
-                ws[f"B{row}"] = None
-                print(f"Cleared existing reason from Excel")
-                break
-
-        wb.save(EXCEL_FILE)
+        index, _ = label_index(ws)
+        row = index.get("reason")
+        if row:
+            set_label(ws, row, None)
+            ws[f"B{row}"] = None
+            print(f"Cleared existing reason from Excel")
 
     except Exception as e:
         print(f"Error clearing previous reason: {e}")
 
-def update_excel_with_reason(reason):
+def update_excel_with_reason(wb, reason):
     """Add or update a 'Reason' line in the Excel summary sheet"""
     try:
-        wb = load_workbook(EXCEL_FILE)
         ws = wb["AP Reconciliation Summary"]
 
         # Check if Reason already exists
-        reason_row = None
-        for row in range(1, 50):
-            if ws[f"A{row}"].value and str(ws[f"A{row}"].value).lower() == "reason":
-                reason_row = row
-                break
+        index, last_row = label_index(ws)
+        reason_row = index.get("reason")
 
         if reason_row:
             # Update existing reason
             ws[f"B{reason_row}"] = reason
             print(f"Updated existing reason in Excel")
         else:
-            # Find the last row with data and add reason
-            last_row = 1
-            for row in range(1, 50):
-                if ws[f"A{row}"].value:
-                    last_row = row
-
-            # Add reason in the next row
-            ws[f"A{last_row + 1}"] = "Reason"
+            # Add reason in the row after the last one with data
+            set_label(ws, last_row + 1, "Reason")
             ws[f"B{last_row + 1}"] = reason
             print(f"Added new reason to Excel")
 
-        wb.save(EXCEL_FILE)
-
     except Exception as e:
         print(f"Error updating Excel with reason: {e}")
 
+def save_workbook(wb):
+    """Write the reconciliation workbook back to disk"""
+    try:
+        wb.save(EXCEL_FILE)
+    except Exception as e:
+        print(f"Error saving Excel: {e}")
+
 def main():
     print("🔍 Starting Variance Investigation...")
 
-    # Clear previous reason from Excel
-    clear_previous_reason()
-
-    # Read MoM percentage
+    # Read MoM percentage (lightweight read-only load)
     mom_percent = read_mom_percentage()
 
-    # Check if investigation is needed
+    # Check if investigation is needed before doing any heavy reads or writes
     if abs(mom_percent) <= THRESHOLD_PERCENT:
         print(f"MoM % Change ({mom_percent:.1f}%) is within threshold ({THRESHOLD_PERCENT}%), no investigation needed.")
         return
 
     print(f"MoM % Change ({mom_percent:.1f}%) exceeds threshold, investigating...")
 
-    # Gather investigation data
-    summary_info = read_ap_summary()
-    detail_info = read_reconciliation_detail()
-    sept_gl_info = read_september_gl_entries()
-    email_content = read_emails_for_investigation()
+    # Open the workbook once; all edits are saved together at the end
+    wb = load_workbook(EXCEL_FILE)
+
+    # Clear previous reason from Excel
+    clear_previous_reason(wb)
+
+    # Gather investigation data. The sheet readers only touch the workbook already in
+    # memory, so they run here; the file-bound GL and email loads are overlapped, with
+    # their log lines buffered and printed in order once both have finished
+    summary_info = read_ap_summary(wb)
+    detail_info = read_reconciliation_detail(wb)
+    gl_log, email_log = [], []
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        gl_future = executor.submit(read_september_gl_entries, log=gl_log.append)
+        email_future = executor.submit(read_emails_for_investigation, log=email_log.append)
+    sept_gl_info = gl_future.result()
+    email_content = email_future.result()
+    for line in gl_log + email_log:
+        print(line)
 
     # Generate AI-based reason
     reason = generate_investigation_reason(mom_percent, summary_info, detail_info, sept_gl_info, email_content)
 
     # Update Excel with reason
-    update_excel_with_reason(reason)
+    update_excel_with_reason(wb, reason)
+    save_workbook(wb)
 
-    print("✅ Variance investigation complete.")
-    print(f"Reason: {reason}")
+    # The reason itself was already streamed to the console as it was generated
+    print(f"✅ Variance investigation complete. Reason saved to {EXCEL_FILE}.")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file